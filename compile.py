@@ -1,9 +1,13 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
+from bisect import bisect_right
 from iteration_utilities import deepflatten
 from parsimonious import Grammar, NodeVisitor
+from parsimonious.exceptions import ParseError, IncompleteParseError
 import parsimonious.nodes as pNodes
+import json
+import re
 import sys
 
 def reccursive_debug_list(arg):
@@ -13,6 +17,13 @@ def reccursive_debug_list(arg):
         return out
     return str(arg)
 
+def line_starts(text):
+    return [0]+[i+1 for i, char in enumerate(text) if char=='\n']
+
+def location(node, starts):
+    line = bisect_right(starts, node.start)
+    return (line, node.start-starts[line-1]+1)
+
 def traceback(e):
     print('Custom traceback:')
     print('File "{}", line {}, in {}'.format(e.__traceback__.tb_frame.f_code.co_filename, e.__traceback__.tb_frame.f_code.co_firstlineno, e.__traceback__.tb_frame.f_code.co_name))
@@ -97,10 +108,149 @@ COMMENT = INDENT* ~"(\/\*.*?\*\/)|(\/\/.*\n)"s
 """)
 
 parse = None
+js = None
+owners = None
+
+# The rules whose results actually get reused while backtracking, memoizing only
+# these parses about as fast as memoizing everything with a third less memory.
+REUSED_RULES = ['value', 'function', 'IDENTIFIER', 'WHITESPACE', 'INDENT']
+
+class ForgetfulCache(dict):
+    def __setitem__(self, pos, node):
+        pass
+
+forgetful = ForgetfulCache()
+
+class CountingCache(dict):
+    def __init__(self, counts, memoize, own):
+        dict.__init__(self)
+        self.counts = counts
+        self.memoize = memoize
+        self.own = own
+    def __contains__(self, pos):
+        self.counts['lookups'] += 1
+        if self.own:
+            self.counts['calls'] += 1
+        if dict.__contains__(self, pos):
+            if self.own:
+                self.counts['hits'] += 1
+                if dict.__getitem__(self, pos) is None:
+                    self.counts['backtracks'] += 1
+            return True
+        return False
+    def __setitem__(self, pos, node):
+        if node is None and self.own:
+            self.counts['backtracks'] += 1
+        if not self.memoize:
+            return
+        if not dict.__contains__(self, pos):
+            self.counts['entries'] += 1
+        dict.__setitem__(self, pos, node)
+
+# Stands in for parsimonious' {id(expr): {pos: node}} packrat cache, anonymous
+# subexpressions are memoized and counted with the rule they are part of.
+class PackratCache(dict):
+    def __init__(self, memoize=None, stats=None):
+        dict.__init__(self)
+        self.memoize = memoize
+        self.stats = stats
+    def __missing__(self, oid):
+        rule, own = rule_owners().get(oid, ('', False))
+        memoize = self.memoize is None or rule in self.memoize
+        if self.stats is None:
+            cache = {} if memoize else forgetful
+        else:
+            if rule not in self.stats:
+                self.stats[rule] = {'calls': 0, 'hits': 0, 'backtracks': 0, 'lookups': 0, 'entries': 0}
+            cache = CountingCache(self.stats[rule], memoize, own)
+        self[oid] = cache
+        return cache
+
+def rule_owners():
+    global owners
+    if owners is None:
+        owners = {}
+        def walk(expr, rule):
+            if id(expr) in owners:
+                return
+            owners[id(expr)] = (rule, expr.name==rule)
+            for member in getattr(expr, 'members', ()):
+                walk(member, member.name or rule)
+        for name, expr in grammar.items():
+            walk(expr, name)
+    return owners
 
-def perform_actions(ns):
+def parse_ns(text, memoize=None, stats=None):
+    if memoize is None and stats is None:
+        return grammar.parse(text)
+    rule = grammar.default_rule
+    error = ParseError(text)
+    cache = PackratCache(memoize, stats)
+    node = rule.match_core(text, 0, cache, error)
+    if any(type(key)==tuple for key in cache):
+        # parsimonious before 0.10 keys one flat cache by (id, pos)
+        raise RuntimeError('--memoize and --parse-stats need parsimonious 0.10.0 or newer')
+    if node is None:
+        raise error
+    if node.end<len(text):
+        raise IncompleteParseError(text, node.end, rule)
+    return node
+
+def stats_table(stats):
+    out = '{:<14} {:>10} {:>10} {:>6} {:>10} {:>10} {:>10}\n'.format('rule', 'calls', 'hits', 'hit%', 'backtracks', 'lookups', 'entries')
+    for rule, counts in sorted(stats.items(), key=lambda item: item[1]['calls'], reverse=True):
+        out += '{:<14} {:>10} {:>10} {:>6.1f} {:>10} {:>10} {:>10}\n'.format(
+            rule,
+            counts['calls'],
+            counts['hits'],
+            100*counts['hits']/counts['calls'] if counts['calls'] else 0,
+            counts['backtracks'],
+            counts['lookups'],
+            counts['entries'])
+    return out
+
+# Every instrumented module keeps its counters in globalThis.__ns_prof[source],
+# so scripts sharing a global scope neither reset nor mix each other's counts.
+# The recursion depth and start time of every timer are kept apart in
+# __ns_timers so only the counters get dumped.
+profiler = r"""var __ns_prof = globalThis.__ns_prof = globalThis.__ns_prof || {};
+var __ns_timers = globalThis.__ns_timers = globalThis.__ns_timers || {};
+function __ns_enter(module, key) {
+    var counters = __ns_prof[module] || (__ns_prof[module] = {});
+    var timers = __ns_timers[module] || (__ns_timers[module] = {});
+    var entry = counters[key] || (counters[key] = {calls: 0, iterations: 0, time: 0});
+    var timer = timers[key] || (timers[key] = {depth: 0, start: 0});
+    entry.calls++;
+    if (timer.depth++ === 0) timer.start = performance.now();
+}
+function __ns_exit(module, key) {
+    var timer = __ns_timers[module][key];
+    if (--timer.depth === 0) __ns_prof[module][key].time += performance.now() - timer.start;
+}
+function __ns_iter(module, key, cond) {
+    if (cond) __ns_prof[module][key].iterations++;
+    return cond;
+}
+function __ns_wrap(module, key, name, source, fn) {
+    var wrapped = function () {
+        __ns_enter(module, key);
+        try { return fn.apply(this, arguments); }
+        finally { __ns_exit(module, key); }
+    };
+    Object.defineProperty(wrapped, 'name', {value: name});
+    Object.defineProperty(wrapped, 'length', {value: fn.length});
+    Object.defineProperty(wrapped, 'toString', {value: () => source});
+    return wrapped;
+}
+if (typeof process !== 'undefined' && typeof require !== 'undefined') {
+    process.on('exit', () => require('fs').writeFileSync({dump}, JSON.stringify({source: {source}, counters: __ns_prof[{source}] || {}})));
+}
+"""
+
+def perform_actions(ns, instrument=False, source='<stdin>', memoize=None, stats=None):
     global ast
-    ast = grammar.parse(ns.replace('\t', '    '))
+    ast = parse_ns(ns.replace('\t', '    '), memoize, stats)
+    starts = line_starts(ast.full_text) if instrument else None
     class Module:
         def __init__(self, body):
             self.body = deepflatten(body[1][0])
@@ -172,9 +322,10 @@ def perform_actions(ns):
         def __str__(self):
             return '{} {}'.format(str(self.name), ' '.join([str(x) for x in self.args]))
     class Lambda:
-        def __init__(self, args=[], result=None):
+        def __init__(self, args=[], result=None, loc=None):
             self.args = args
             self.result = result
+            self.loc = loc
         @property
         def text(self):
             return str(self)
@@ -186,9 +337,10 @@ def perform_actions(ns):
         def __str__(self):
             return '{} -> {}'.format(' '.join([str(x) for x in self.args]), str(self.result))
     class FromLoop:
-        def __init__(self, from_=None, to_=None):
+        def __init__(self, from_=None, to_=None, loc=None):
             self.from_ = from_
             self.to_ = to_
+            self.loc = loc
         @property
         def text(self):
             return str(self)
@@ -333,7 +485,7 @@ def perform_actions(ns):
                     if child.text=='->':
                         continue
                     expr = child
-                return Lambda(args, expr)
+                return Lambda(args, expr, location(node, starts) if starts else None)
             except Exception as e:
                 print('Function error: {}'.format(e))
                 return visited_children or node.children
@@ -368,7 +520,7 @@ def perform_actions(ns):
                     finals.append(part)
                 assert finals[0].text=='from'
                 assert finals[2].text=='to'
-                return FromLoop(finals[1], finals[3])
+                return FromLoop(finals[1], finals[3], location(node, starts) if starts else None)
             except Exception as e:
                 print('FromLoop error: {}'.format(e))
                 return visited_children or node
@@ -554,24 +706,55 @@ def perform_actions(ns):
     def reparse(tree):
         newtree = TrickOrTreater().visit(tree)
         return newtree
-    def javascript(module):
+    def javascript(module, instrument=False, record=False):
         global block
         global scope
+        global closer
         scope = []
         builtins = ['skip', 'break', 'return']
         indent = 0
         block = False
-        def lambda2js(expr):
+        closer = ''
+        closers = []
+        heads = []
+        opened = {}
+        def probe(kind, loc):
+            return '{}, {}'.format(json.dumps(source), json.dumps('{}@{}:{}'.format(kind, *loc)))
+        def close(out, keys):
+            # when recording, closers hold the keys of the lambdas whose block ends there
+            if not record:
+                return out+keys
+            for key in keys.split():
+                if key in opened:
+                    sources[key] = out[opened.pop(key):]
+            return out
+        def lambda2js(expr, name=''):
+            # name is what javascript would call the arrow function where it is
+            # defined, and the wrapper's toString gives the source recorded without instrumentation
             global block
+            global closer
+            key = '{}:{}'.format(*expr.loc) if expr.loc else None
             if expr.result:
-                return '({}) => {}'.format(', '.join([str(x) for x in expr.args]), expr2js(expr.result))
+                js = '({}) => {}'.format(', '.join([str(x) for x in expr.args]), expr2js(expr.result))
+                if record:
+                    sources[key] = js
+                if instrument:
+                    js = '__ns_wrap({}, {}, {}, {})'.format(probe('function', expr.loc), json.dumps(name), json.dumps(sources[key]), js)
+                return js
             else:
                 block = True
-                return '({}) =>'.format(', '.join([str(x) for x in expr.args]))
+                js = '({}) =>'.format(', '.join([str(x) for x in expr.args]))
+                if record:
+                    heads.append((key, js))
+                    closer += ' '+key
+                if instrument:
+                    js = '__ns_wrap({}, {}, {}, {}'.format(probe('function', expr.loc), json.dumps(name), json.dumps(sources[key]), js)
+                    closer = ')'
+                return js
         def cond2js(cond):
-            left = expr2js(cond.left)
+            left = expr2js(cond.left, type(cond.left)==Lambda)
             comp = cond.comp
-            right = expr2js(cond.right)
+            right = expr2js(cond.right, type(cond.right)==Lambda)
             if comp in ['=', 'is']:           comp = '==='
             if comp in ['!=', 'is not']:      comp = '!=='
             if comp in ['>', 'is more than']: comp = '>'
@@ -582,6 +765,8 @@ def perform_actions(ns):
         def obj2js(obj):
             js = '{'
             def el2obj(el):
+                if type(el[1])==Lambda and type(el[0]) in [str, int, Name]:
+                    return expr2js(el[0]) + ': ' + lambda2js(el[1], str(el[0]))
                 return expr2js(el[0]) + ': ' + expr2js(el[1])
             js += ', '.join(map(el2obj, obj))
             js += '}'
@@ -631,15 +816,21 @@ def perform_actions(ns):
             if type(vardef.to)!=Lambda:
                 return '{} = {};'.format(name, expr2js(vardef.to))
             else:
+                binding = name.name if type(name)==Name and '.' not in name.name else ''
                 if vardef.to.result:
-                    return '{} = {};'.format(name, expr2js(vardef.to))
+                    return '{} = {};'.format(name, lambda2js(vardef.to, binding))
                 else:
-                    return '{} = {}'.format(name, expr2js(vardef.to))
+                    return '{} = {}'.format(name, lambda2js(vardef.to, binding))
         def fromloop2js(loop, variable):
             global block
+            global closer
             block = True
             if variable=='name':
                 variable = '_name'
+            if instrument:
+                key = probe('from', loop.loc)
+                closer = ' }} finally {{ __ns_exit({}); }}'.format(key)
+                return 'try {{ __ns_enter({3}); for ({0} = {1}; __ns_iter({3}, {0}++ < {2});)'.format(variable, loop.from_, loop.to_, key)
             return 'for ({0} = {1}; {0}++ < {2};)'.format(variable, loop.from_, loop.to_)
         def funccall2js(call):
             name = expr2js(call.name)
@@ -668,17 +859,24 @@ def perform_actions(ns):
         out = ''
         scope.append([])
         for stmt in module.body:
+            dangling = closer
+            closer = ''
             while stmt.indent<indent:
                 indent -= 1
                 if len(scope[-1])>0:
                     out += '    '*stmt.indent+'var '+', '.join(scope[-1])+';\n'
+                out = close(out, dangling)
+                dangling = ''
                 scope = scope[:-1]
-                out += '    '*stmt.indent+'}\n'
+                out = close(out+'    '*stmt.indent+'}', closers.pop())+'\n'
             while stmt.indent>indent:
                 out += ' {\n'
                 scope.append([])
+                closers.append(dangling)
+                dangling = ''
                 indent += 1
             out += '    '*stmt.indent
+            line = len(out)
             if type(stmt.expr)==VarDef:
                 out += vardef2js(stmt.expr)
             if type(stmt.expr)==ElseStat:
@@ -690,6 +888,19 @@ def perform_actions(ns):
                 out += funccall2js(FuncCall(stmt.expr, []))
             if type(stmt.expr)==FuncCall:
                 out += funccall2js(stmt.expr) + ';'
+            for key, head in heads:
+                start = out.rfind(head, line)
+                if start>=0:
+                    opened[key] = start
+            heads.clear()
+            if dangling:
+                # the previous statement never got its block, so this one is its body
+                if block:
+                    closer += dangling
+                elif (record or dangling.startswith(')')) and out.endswith(';'):
+                    out = close(out[:-1], dangling)+';'
+                else:
+                    out = close(out, dangling)
             if block:
                 block = False
             else:
@@ -698,16 +909,28 @@ def perform_actions(ns):
             indent -= 1
             if len(scope[-1])>0:
                 out += '    '*stmt.indent+'var '+', '.join(scope[-1])+';\n'
+            out = close(out, closer)
+            closer = ''
             scope = scope[:-1]
-            out += '}'
+            out = close(out+'}', closers.pop())
+        out = close(out, closer)
         if len(scope[0])>0:
-            defs = 'var '+', '.join(scope[0])+';'
-            return defs+'\n'+out
-        else:
-            return out
+            out = 'var '+', '.join(scope[0])+';'+'\n'+out
+        if instrument:
+            values = {
+                'dump': json.dumps(source.replace('\\', '/').split('/')[-1]+'.prof.json'),
+                'source': json.dumps(source),
+            }
+            out = re.sub(r'\{(dump|source)\}', lambda m: values[m.group(1)], profiler)+out
+        return out
     global parse
+    global js
     parse = reparse(ast)
-    print(javascript(parse))
+    sources = {}
+    if instrument:
+        javascript(parse, record=True)
+    js = javascript(parse, instrument)
+    print(js)
     return str(ast)
 
 if __name__ == '__main__':
@@ -716,9 +939,24 @@ if __name__ == '__main__':
                         help='The input nicescript file')
     parser.add_argument('-o', type=str, default='a.out',
                         help='The output file.')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Wrap every lambda and from loop with call counters and timers.')
+    parser.add_argument('--memoize', type=str, default=None, metavar='RULES',
+                        help='Only memoize these comma separated grammar rules, "reused" for the ones whose results get reused, or "" for none. (defaults to all)')
+    parser.add_argument('--parse-stats', action='store_true',
+                        help='Print how often every grammar rule was tried, hit the cache and backtracked to stderr.')
     args = parser.parse_args()
+    memoize = args.memoize
+    if memoize is not None:
+        memoize = REUSED_RULES if memoize=='reused' else [x for x in memoize.split(',') if x]
+        for rule in memoize:
+            if rule not in grammar:
+                parser.error('unknown grammar rule: {}'.format(rule))
+    stats = {} if args.parse_stats else None
     with open(args.o, 'w') as fout:
         with open(args.input, 'r') as fin:
-            fout.write(perform_actions(fin.read()))
+            fout.write(perform_actions(fin.read(), args.instrument, args.input, memoize, stats))
             fin.close()
         fout.close()
+    if stats is not None:
+        print(stats_table(stats), end='', file=sys.stderr)
@@ -1,2 +1,2 @@
 @pip install iteration-utilities
-@pip install parsimonious
\ No newline at end of file
+@pip install "parsimonious>=0.10.0"
\ No newline at end of file
@@ -1,3 +1,3 @@
 #!/usr/bin/sh
 pip install iteration-utilities
-pip install parsimonious
\ No newline at end of file
+pip install "parsimonious>=0.10.0"
\ No newline at end of file
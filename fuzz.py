@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import compile as nicescript
+
+# Modes whose javascript must match the reference byte for byte.
+MODES = {
+    'reference': {},
+    'memoize-reused': {'memoize': nicescript.REUSED_RULES},
+    'memoize-none': {'memoize': []},
+    'parse-stats': {'stats': {}},
+}
+# Modes that change the javascript but must not change what it does.
+RUNTIME_MODES = {
+    'instrument': {'instrument': True},
+}
+
+NAMES = ['a', 'b', 'c', 'total', 'items', 'name', 'f', 'g']
+ARGS = ['x', 'y', 'z']
+COUNTERS = ['i', 'j', 'k', 'l', 'm', 'n']
+# How often to use a construct the reference front-end rejects, against a total
+# weight of about 40 for a value. Programs using them only exercise the modes'
+# error paths, so they are kept rare enough that most programs still run.
+REJECTED = 0.2
+
+class Generator:
+    def __init__(self, seed, depth=3):
+        self.rand = random.Random(seed)
+        self.depth = depth
+    def choice(self, weighted):
+        options, weights = zip(*weighted)
+        return self.rand.choices(options, weights)[0]
+    def IDENTIFIER(self):
+        return self.rand.choice(NAMES)
+    def NUMBER(self):
+        return str(self.rand.randrange(100))
+    def STRING(self):
+        quote = self.rand.choice(['"', "'", '`'])
+        word = self.rand.choice('abcxyz')+''.join(self.rand.choice('abcxyz ') for _ in range(self.rand.randrange(5)))
+        return quote+word+quote
+    def REGEX(self):
+        return '/'+self.rand.choice(['a+', 'b*c', '[xy]', 'z?'])+'/'
+    def array(self, depth, args=[]):
+        items = [self.value(depth-1, args) for _ in range(self.rand.randrange(2, 4))]
+        return '['+', '.join(items)+']'
+    def object(self, depth):
+        return '{}'
+    def function(self, depth):
+        args = self.rand.sample(ARGS, self.rand.randrange(1, 3))
+        body = self.choice([
+            (lambda: '{} {} {}'.format(self.rand.choice(args), self.rand.choice('+-*/%'), self.value(depth-1, args)), 3),
+            (lambda: self.rand.choice(args), 1),
+            (lambda: '{} {}'.format(self.rand.choice(['f', 'g']), self.rand.choice(args)), 1),
+        ])()
+        return '{} -> {}'.format(' '.join(args), body)
+    def algebraic(self, depth, args=[]):
+        op = self.rand.choice('+-*/%.')
+        if op=='.':
+            # javascript only takes a name after a dot
+            return '{} . {}'.format(self.value(depth, args), self.rand.choice(NAMES))
+        return '{} {} {}'.format(self.value(depth, args), op, self.value(depth, args))
+    def parened(self, depth, args=[]):
+        return self.choice([
+            (lambda: self.algebraic(depth, args), 3),
+            (lambda: '{} {} {}'.format(self.value(depth, args), self.rand.choice(['plus', 'minus', 'times', 'by', 'over', 'mod']), self.value(depth, args)), 2),
+            (lambda: self.functioncall(depth, args), 2),
+        ])()
+    def rejected(self, depth, args=[]):
+        # NUMBER tries [0-9]+ before 0x, SEM_MOD tries mod before modulo,
+        # regexes clash with '/' and the visitors choke on the rest.
+        return self.choice([
+            (lambda: '({})'.format(self.value(depth-1, args)), 1),
+            (lambda: '{} modulo {}'.format(self.NUMBER(), self.value(depth-1, args)), 1),
+            (lambda: '0x{:X}'.format(self.rand.randrange(256)), 1),
+            (lambda: self.REGEX(), 1),
+            (lambda: self.rand.choice(['undefined', 'null']), 1),
+            (lambda: '{}[{}]'.format(self.rand.choice(args or NAMES), self.value(depth-1, args)), 1),
+            (lambda: '[{}]'.format(self.value(depth-1, args)), 1),
+            (lambda: '{{{}: {}}}'.format(self.STRING(), self.value(depth-1, args)), 1),
+        ])()
+    def value(self, depth, args=[]):
+        if depth<=0:
+            return self.choice([(self.NUMBER, 4), (self.STRING, 2), (lambda: self.rand.choice(args or NAMES), 4)])()
+        return self.choice([
+            (lambda: self.NUMBER(), 12),
+            (lambda: self.STRING(), 6),
+            (lambda: self.rand.choice(args or NAMES), 12),
+            (lambda: self.array(depth, args), 2),
+            (lambda: self.object(depth), 1),
+            (lambda: '({})'.format(self.function(depth)), 2),
+            (lambda: '({})'.format(self.parened(depth-1, args)), 4),
+            (lambda: self.rejected(depth, args), REJECTED),
+        ])()
+    def expr(self, depth, args=[]):
+        return self.choice([
+            (lambda: '{} {} {}'.format(self.value(depth, args), self.rand.choice('+-*/%'), self.value(depth, args)), 3),
+            (lambda: self.value(depth, args), 6),
+        ])()
+    def expr_func(self, depth, args=[]):
+        return self.choice([
+            (lambda: self.algebraic(depth, args), 3),
+            (lambda: '{} {} {}'.format(self.value(depth, args), self.rand.choice(['plus', 'minus', 'times', 'by', 'over', 'mod']), self.value(depth, args)), 2),
+            (lambda: self.functioncall(depth, args), 2),
+            (lambda: self.value(depth, args), 3),
+        ])()
+    def functioncall(self, depth, args=[]):
+        name = self.rand.choice(['print', 'f', 'g'])
+        return '{} {}'.format(name, ' '.join(self.expr(depth-1, args) for _ in range(self.rand.randrange(1, 3))))
+    def cond(self, depth):
+        comparison = self.choice([(x, 1) for x in ['<', '>', '=', '!=', 'is', 'is not', 'is more than', 'is less than']]+[('<=', 0.05), ('>=', 0.05)])
+        return '{} {} {}'.format(self.value(depth), comparison, self.value(depth))
+    def block(self, indent, depth):
+        return [line for _ in range(self.rand.randrange(1, 4)) for line in self.statement(indent, depth)]
+    def statement(self, indent, depth):
+        pad = '    '*indent
+        kind = self.choice([
+            ('vardef', 6),
+            ('call', 5),
+            ('lambda', 2 if depth>0 else 0),
+            ('fromloop', 2 if depth>0 else 0),
+            ('ifstat', 3 if depth>0 else 0),
+            ('comment', 1),
+        ])
+        if kind=='vardef':
+            return [pad+'{} {} {}'.format(self.IDENTIFIER(), self.rand.choice(['=', 'is']), self.expr_func(depth))]
+        if kind=='call':
+            return [pad+'print '+self.expr(depth)]
+        if kind=='comment':
+            return [pad+'/* '+self.STRING()[1:-1]+' */']
+        if kind=='lambda':
+            name = self.rand.choice(['f', 'g'])
+            if self.rand.random()<0.5:
+                lines = [pad+'{} = {}'.format(name, self.function(depth))]
+            else:
+                args = self.rand.sample(ARGS, self.rand.randrange(1, 3))
+                lines = [pad+'{} = {} ->'.format(name, ' '.join(args))]
+                lines += self.block(indent+1, depth-1)
+                lines += ['    '*(indent+1)+'return '+self.expr(depth-1, args)]
+            return lines
+        if kind=='fromloop':
+            lines = [pad+'{} {} from {} to {}'.format(COUNTERS[indent], self.rand.choice(['=', 'is']), self.rand.randrange(3), self.rand.randrange(2, 8))]
+            return lines + self.block(indent+1, depth-1)
+        lines = [pad+'if '+self.cond(depth)]
+        lines += self.block(indent+1, depth-1)
+        if self.rand.random()<0.4:
+            lines += [pad+'else'] + self.block(indent+1, depth-1)
+        return lines
+    def module(self):
+        # javascript throws on names that were never assigned, so start with all of them
+        lines = ['{} = {}'.format(name, self.NUMBER()) for name in NAMES if name not in ['f', 'g']]
+        lines += ['f = x -> x + 1', 'g = x y -> x * y']
+        for _ in range(self.rand.randrange(1, 8)):
+            lines += self.statement(0, self.depth)
+        return '\n'.join(lines)+'\n'
+
+def compile_with(program, options):
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            nicescript.perform_actions(program, source='fuzz.ns', **options)
+        return ('ok', out.getvalue(), nicescript.js)
+    except (Exception, SystemExit) as e:
+        return (type(e).__name__, out.getvalue(), None)
+
+def run_js(js):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'program.js')
+        with open(path, 'w') as f:
+            f.write(js)
+            f.close()
+        try:
+            proc = subprocess.run(['node', path], cwd=tmp, capture_output=True, text=True, timeout=5)
+        except subprocess.TimeoutExpired:
+            return ('timeout', '')
+        if proc.returncode and 'SyntaxError' in proc.stderr:
+            return ('syntax', '')
+        if proc.returncode and 'Maximum call stack size exceeded' in proc.stderr:
+            # instrumented calls use more stack, so runaway recursion overflows
+            # sooner and how much it printed first is not comparable
+            return ('overflow', '')
+        return (proc.returncode, proc.stdout)
+
+# The modes that disagree with the reference, and whether it compiled and ran.
+def check(program, node=True):
+    mismatches = []
+    outcomes = {name: compile_with(program, options) for name, options in MODES.items()}
+    reference = outcomes['reference']
+    for name, outcome in outcomes.items():
+        if outcome!=reference:
+            mismatches.append(name)
+    behaviour = None
+    for name, options in RUNTIME_MODES.items():
+        outcome = compile_with(program, options)
+        if outcome[0]!=reference[0]:
+            mismatches.append(name)
+            continue
+        if not node or reference[0]!='ok':
+            continue
+        if behaviour is None:
+            behaviour = run_js(reference[2])
+        if behaviour[0]=='syntax':
+            # the reference javascript is already broken, there is no behaviour to preserve
+            continue
+        if run_js(outcome[2])!=behaviour:
+            mismatches.append(name)
+    ran = behaviour is not None and behaviour[0]==0
+    return tuple(mismatches), reference[0]=='ok', ran
+
+def fuzz_one(job):
+    seed, depth, node = job
+    program = Generator(seed, depth).module()
+    return seed, program, check(program, node)
+
+def minimize(program, mismatches, node=True):
+    lines = program.split('\n')
+    chunk = len(lines)//2
+    while chunk>=1:
+        i = 0
+        while i<len(lines):
+            candidate = lines[:i]+lines[i+chunk:]
+            if candidate and check('\n'.join(candidate), node)[0]==mismatches:
+                lines = candidate
+            else:
+                i += chunk
+        chunk //= 2
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1000,
+                        help='How many programs to generate. (defaults to 1000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the first program. (defaults to 0)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='How deeply expressions and blocks nest. (defaults to 3)')
+    parser.add_argument('-j', type=int, default=os.cpu_count(),
+                        help='How many worker processes to use. (defaults to the number of cpus)')
+    parser.add_argument('--no-node', action='store_true',
+                        help='Only compare compiler output, never run the javascript.')
+    args = parser.parse_args()
+    node = not args.no_node and shutil.which('node') is not None
+    if not node:
+        print('Not running javascript, runtime modes are only checked for compile errors.')
+    failures = []
+    compiled = 0
+    ran = 0
+    start = time.time()
+    jobs = [(seed, args.depth, node) for seed in range(args.seed, args.seed+args.n)]
+    with multiprocessing.Pool(args.j) as pool:
+        for done, (seed, program, (mismatches, did_compile, did_run)) in enumerate(pool.imap_unordered(fuzz_one, jobs, chunksize=8), 1):
+            if mismatches:
+                failures.append((seed, program, mismatches))
+            compiled += did_compile
+            ran += did_run
+            if done%100==0 or done==args.n:
+                print('{} programs, {} failures, {:.1f} programs/sec, {:.0%} compiled, {:.0%} ran'.format(done, len(failures), done/(time.time()-start), compiled/done, ran/done))
+        pool.close()
+    for seed, program, mismatches in sorted(failures):
+        print('\nSeed {} differs in {}:'.format(seed, ', '.join(mismatches)))
+        print(minimize(program, mismatches, node))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+
+def load_counters(path):
+    with open(path, 'r') as f:
+        dump = json.load(f)
+        f.close()
+    if 'counters' in dump:
+        return dump.get('source'), dump['counters']
+    return None, dump
+
+def load_source(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        lines = f.read().replace('\t', '    ').splitlines()
+        f.close()
+    return lines
+
+def hotspots(counters, sort='time'):
+    rows = []
+    for key, entry in counters.items():
+        kind, loc = key.split('@')
+        line, col = [int(x) for x in loc.split(':')]
+        rows.append({
+            'kind': kind,
+            'line': line,
+            'col': col,
+            'calls': entry.get('calls', 0),
+            'iterations': entry.get('iterations', 0),
+            'time': entry.get('time', 0),
+        })
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows
+
+def report(rows, lines, limit=None):
+    out = '{:>9} {:>8} {:>10} {:>10} {:>12} {:>10}  {}\n'.format('location', 'kind', 'calls', 'iterations', 'total ms', 'ms/call', 'source')
+    for row in rows[:limit]:
+        source = ''
+        if 0<row['line']<=len(lines):
+            source = lines[row['line']-1].strip()
+        out += '{:>9} {:>8} {:>10} {:>10} {:>12.3f} {:>10.4f}  {}\n'.format(
+            '{}:{}'.format(row['line'], row['col']),
+            row['kind'],
+            row['calls'],
+            row['iterations'] if row['kind']=='from' else '',
+            row['time'],
+            row['time']/row['calls'] if row['calls'] else 0,
+            source)
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', metavar='prof_file', type=str,
+                        help='The counters dumped by a program compiled with --instrument')
+    parser.add_argument('-s', '--source', type=str, default=None,
+                        help='The nicescript file the program was compiled from. (defaults to the one recorded in the dump)')
+    parser.add_argument('-n', type=int, default=None,
+                        help='Only show the n hottest locations.')
+    parser.add_argument('--sort', choices=['time', 'calls', 'iterations'], default='time',
+                        help='The column to sort by. (defaults to time)')
+    args = parser.parse_args()
+    source, counters = load_counters(args.input)
+    if args.source:
+        source = args.source
+    elif source and not os.path.isabs(source):
+        source = os.path.join(os.path.dirname(args.input), source)
+    print(report(hotspots(counters, args.sort), load_source(source), args.n), end='')